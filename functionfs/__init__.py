@@ -21,18 +21,16 @@ Defines standard USB descriptors (see "ch9" sub-module) and sends them to the
 kernel to declare function's structure.
 Provides methods for accessing each endpoint and to react to events.
 """
+import bisect
 import ctypes
 import errno
 import fcntl
 import functools
 import io
-import itertools
-import math
 import mmap
 import os
 import select
 import struct
-import warnings
 import libaio
 from .common import (
     USBDescriptorHeader,
@@ -65,7 +63,6 @@ from .functionfs import (
     DescsHeadV2,
     DescsHead,
     OSDescHeader,
-    OSDescHeaderBCount,
     OSExtCompatDesc,
     OSExtPropDescHead,
     StringsHead,
@@ -111,26 +108,62 @@ __all__ = (
     'getUSBHIDDescriptorClass',
 )
 
-_MAX_PACKET_SIZE_DICT = {
-    ch9.USB_ENDPOINT_XFER_ISOC: (
+# Indexed by transfer type (USB_ENDPOINT_XFER_*).
+_MAX_PACKET_SIZE_TABLE = (
+    None, # USB_ENDPOINT_XFER_CONTROL: not available to functions
+    ( # USB_ENDPOINT_XFER_ISOC
         1023,   # 0..1023
         1024,   # 0..1024
         1024,   # 0..1024
     ),
-    ch9.USB_ENDPOINT_XFER_BULK: (
+    ( # USB_ENDPOINT_XFER_BULK
         64,     # 8, 16, 32, 64
         512,    # 512 only
         1024,   # 1024 only
     ),
-    ch9.USB_ENDPOINT_XFER_INT: (
+    ( # USB_ENDPOINT_XFER_INT
         64,     # 0..64
         1024,   # 0..1024
         1024,   # 1..1024
     ),
-}
+)
+# High-speed bInterval is the nearest exponent n (1..16) so that
+# 2 ** (n - 1) micro-frames match the requested interval, in milliseconds.
+# Rounding happens in the exponent domain, so the boundary between n and
+# n + 1 is at 2 ** (n - .5) micro-frames. 8 is the number of micro-frames in
+# a millisecond.
+_HS_INTERVAL_THRESHOLD_LIST = tuple(
+    2 ** (exponent + .5) / 8
+    for exponent in range(15)
+)
+
+# Structure sizes never change, but ctypes.sizeof recomputes them on each
+# call: remember them for the classes which are used repeatedly.
+# This and other structure-keyed caches below are bounded, as some classes
+# are created per instance (ex: HID descriptors) and would otherwise be kept
+# alive forever.
+_sizeof = functools.lru_cache(maxsize=256)(ctypes.sizeof)
+_STRING_BASE_SIZE = ctypes.sizeof(StringBase)
+
+# OSDescHeader, for each type of extension (with bCount and Reserved, or with
+# wCount).
+_OS_DESC_COMPAT_HEADER_STRUCT = struct.Struct('<BIHHBx')
+_OS_DESC_PROP_HEADER_STRUCT = struct.Struct('<BIHHH')
+assert (
+    _OS_DESC_COMPAT_HEADER_STRUCT.size ==
+    _OS_DESC_PROP_HEADER_STRUCT.size ==
+    ctypes.sizeof(OSDescHeader)
+)
+# OSExtPropDescHead, packed before the variable-length name and value.
+_OS_EXT_PROP_DESC_HEAD_STRUCT = struct.Struct('<IIH')
+assert _OS_EXT_PROP_DESC_HEAD_STRUCT.size == ctypes.sizeof(OSExtPropDescHead)
 
 _MARKER = object()
 _EMPTY_DICT = {} # For internal ** fallback usage
+# Endpoint keyword arguments getInterfaceInAllSpeeds computes itself.
+_ENDPOINT_OVERRIDE_KEY_SET = frozenset(
+    ('bEndpointAddress', 'bInterval', 'wMaxPacketSize'),
+)
 def getInterfaceInAllSpeeds(interface, endpoint_list, class_descriptor_list=()):
     """
     Produce similar fs, hs and ss interface and endpoints descriptors.
@@ -193,85 +226,118 @@ def getInterfaceInAllSpeeds(interface, endpoint_list, class_descriptor_list=()):
         endpoint_list[0]['endpoint'].get(
             'bEndpointAddress',
             0,
-        ) & ~ch9.USB_DIR_IN == 0
-    )
+        ) & ~ch9.USB_DIR_IN
+    ) == 0
     for index, endpoint in enumerate(endpoint_list, 1):
-        endpoint_kw = endpoint['endpoint'].copy()
-        transfer_type = endpoint_kw[
-            'bmAttributes'
-        ] & ch9.USB_ENDPOINT_XFERTYPE_MASK
-        fs_max, hs_max, ss_max = _MAX_PACKET_SIZE_DICT[transfer_type]
-        if need_address:
-            endpoint_kw['bEndpointAddress'] = index | (
-                endpoint_kw.get('bEndpointAddress', 0) & ch9.USB_DIR_IN
-            )
-        klass = (
-            USBEndpointDescriptor
-            if 'bRefresh' in endpoint_kw or 'bSynchAddress' in endpoint_kw else
-            USBEndpointDescriptorNoAudio
+        fs_descriptor, hs_descriptor, ss_descriptor_list = (
+            _getEndpointInAllSpeeds(index, endpoint, need_address)
         )
-        interval = endpoint_kw.pop('bInterval', _MARKER)
-        if interval is _MARKER:
-            fs_interval = hs_interval = 0
-        else:
-            if transfer_type == ch9.USB_ENDPOINT_XFER_BULK:
-                fs_interval = 0
-                hs_interval = interval
-            else: # USB_ENDPOINT_XFER_ISOC or USB_ENDPOINT_XFER_INT
-                fs_interval = max(1, min(255, round(interval)))
-                # 8 is the number of micro-frames in a millisecond
-                hs_interval = max(
-                    1,
-                    min(16, int(round(1 + math.log(interval * 8, 2)))),
-                )
-        packet_size = endpoint_kw.pop('wMaxPacketSize', _MARKER)
-        if packet_size is _MARKER:
-            fs_packet_size = fs_max
-            hs_packet_size = hs_max
-            ss_packet_size = ss_max
-        else:
-            fs_packet_size = min(fs_max, packet_size)
-            hs_packet_size = min(hs_max, packet_size)
-            ss_packet_size = min(ss_max, packet_size)
-        fs_list.append(getDescriptor(
-            klass,
-            wMaxPacketSize=fs_packet_size,
-            bInterval=fs_interval,
-            **endpoint_kw
-        ))
-        hs_list.append(getDescriptor(
-            klass,
-            wMaxPacketSize=hs_packet_size,
-            bInterval=hs_interval,
-            **endpoint_kw
-        ))
-        ss_list.append(getDescriptor(
-            klass,
-            wMaxPacketSize=ss_packet_size,
-            bInterval=hs_interval,
-            **endpoint_kw
-        ))
-        ss_companion_kw = endpoint.get('superspeed', _EMPTY_DICT)
-        ss_list.append(getDescriptor(
+        fs_list.append(fs_descriptor)
+        hs_list.append(hs_descriptor)
+        ss_list.extend(ss_descriptor_list)
+    return (fs_list, hs_list, ss_list)
+
+def _getEndpointInAllSpeeds(index, endpoint, need_address):
+    """
+    Produce one endpoint's descriptors for getInterfaceInAllSpeeds.
+
+    Returns a 3-tuple:
+    - fs endpoint descriptor
+    - hs endpoint descriptor
+    - list of ss endpoint descriptor and its companion descriptors
+    """
+    endpoint_kw = endpoint['endpoint']
+    transfer_type = endpoint_kw[
+        'bmAttributes'
+    ] & ch9.USB_ENDPOINT_XFERTYPE_MASK
+    fs_max, hs_max, ss_max = _MAX_PACKET_SIZE_TABLE[transfer_type]
+    klass = (
+        USBEndpointDescriptor
+        if 'bRefresh' in endpoint_kw or 'bSynchAddress' in endpoint_kw else
+        USBEndpointDescriptorNoAudio
+    )
+    address = endpoint_kw.get('bEndpointAddress', 0)
+    if need_address:
+        address = index | (address & ch9.USB_DIR_IN)
+    interval = endpoint_kw.get('bInterval', _MARKER)
+    packet_size = endpoint_kw.get('wMaxPacketSize', _MARKER)
+    if interval is _MARKER:
+        fs_interval = hs_interval = 0
+    else:
+        if transfer_type == ch9.USB_ENDPOINT_XFER_BULK:
+            fs_interval = 0
+            hs_interval = interval
+        else: # USB_ENDPOINT_XFER_ISOC or USB_ENDPOINT_XFER_INT
+            fs_interval = max(1, min(255, round(interval)))
+            hs_interval = 1 + bisect.bisect(
+                _HS_INTERVAL_THRESHOLD_LIST,
+                interval,
+            )
+    if packet_size is _MARKER:
+        fs_packet_size = fs_max
+        hs_packet_size = hs_max
+        ss_packet_size = ss_max
+    else:
+        fs_packet_size = min(fs_max, packet_size)
+        hs_packet_size = min(hs_max, packet_size)
+        ss_packet_size = min(ss_max, packet_size)
+    # Only validate arguments once, and derive other speeds' descriptors
+    # from the full-speed one, as they only differ by these 2 fields.
+    # Caller's dict is left untouched, as it may be shared or read-only.
+    fs_descriptor = getDescriptor(
+        klass,
+        bEndpointAddress=address,
+        wMaxPacketSize=fs_packet_size,
+        bInterval=fs_interval,
+        **{
+            key: value
+            for key, value in endpoint_kw.items()
+            if key not in _ENDPOINT_OVERRIDE_KEY_SET
+        }
+    )
+    hs_descriptor = klass.from_buffer_copy(fs_descriptor)
+    hs_descriptor.wMaxPacketSize = hs_packet_size
+    hs_descriptor.bInterval = hs_interval
+    ss_descriptor = klass.from_buffer_copy(hs_descriptor)
+    ss_descriptor.wMaxPacketSize = ss_packet_size
+    ss_companion_kw = endpoint.get('superspeed', _EMPTY_DICT)
+    ss_descriptor_list = [
+        ss_descriptor,
+        getDescriptor(
             USBSSEPCompDescriptor,
             **ss_companion_kw
+        ),
+    ]
+    ssp_iso_kw = endpoint.get('superspeed_iso', _EMPTY_DICT)
+    need_ssp_iso = (
+        transfer_type == ch9.USB_ENDPOINT_XFER_ISOC and
+        bool(ch9.USB_SS_SSP_ISOC_COMP(
+            ss_companion_kw.get('bmAttributes', 0),
         ))
-        ssp_iso_kw = endpoint.get('superspeed_iso', _EMPTY_DICT)
-        if bool(ssp_iso_kw) != (
-            endpoint_kw.get('bmAttributes', 0) &
-            ch9.USB_ENDPOINT_XFERTYPE_MASK ==
-            ch9.USB_ENDPOINT_XFER_ISOC and
-            bool(ch9.USB_SS_SSP_ISOC_COMP(
-                ss_companion_kw.get('bmAttributes', 0),
-            ))
-        ):
-            raise ValueError('Inconsistent isochronous companion')
-        if ssp_iso_kw:
-            ss_list.append(getDescriptor(
-                USBSSPIsocEndpointDescriptor,
-                **ssp_iso_kw
-            ))
-    return (fs_list, hs_list, ss_list)
+    )
+    if bool(ssp_iso_kw) != need_ssp_iso:
+        raise ValueError('Inconsistent isochronous companion')
+    if ssp_iso_kw:
+        ss_descriptor_list.append(getDescriptor(
+            USBSSPIsocEndpointDescriptor,
+            **ssp_iso_kw
+        ))
+    return (fs_descriptor, hs_descriptor, ss_descriptor_list)
+
+@functools.lru_cache(maxsize=256)
+def _getFieldNameSet(klass):
+    """
+    Return the (cached) set of field names of given structure class, including
+    inherited fields.
+    """
+    result = frozenset(
+        field[0]
+        for base in klass.__mro__
+        for field in vars(base).get('_fields_', ())
+    )
+    assert 'bLength' in result
+    assert 'bDescriptorType' in result
+    return result
 
 def getDescriptor(klass, **kw):
     """
@@ -281,21 +347,35 @@ def getDescriptor(klass, **kw):
     # as structure fields. So check it.
     # This is annoying, but not doing it is a huge waste of time for the
     # developer.
-    empty = klass()
-    assert hasattr(empty, 'bLength')
-    assert hasattr(empty, 'bDescriptorType')
-    unknown = [x for x in kw if not hasattr(empty, x)]
+    field_name_set = _getFieldNameSet(klass)
+    unknown = [x for x in kw if x not in field_name_set]
     if unknown:
         raise TypeError('Unknown fields %r' % (unknown, ))
     # XXX: not very pythonic...
     return klass(
-        bLength=ctypes.sizeof(klass),
+        bLength=_sizeof(klass),
         # pylint: disable=protected-access
         bDescriptorType=klass._bDescriptorType,
         # pylint: enable=protected-access
         **kw
     )
 
+@functools.lru_cache(maxsize=256)
+def _getOSDescType(ext_type, ext_count):
+    """
+    Return the (cached) OSDescHeader subclass holding ext_count ext_type
+    instances.
+    """
+    return type(
+        'OSDesc',
+        (OSDescHeader, ),
+        {
+            '_fields_': [
+                ('ext_list', ext_type * ext_count),
+            ],
+        },
+    )
+
 def getOSDesc(interface, ext_list):
     """
     Return an OS description header.
@@ -309,37 +389,43 @@ def getOSDesc(interface, ext_list):
     except ValueError:
         raise TypeError('Extensions of a single type are required.') from None
     if issubclass(ext_type, OSExtCompatDesc):
+        header_struct = _OS_DESC_COMPAT_HEADER_STRUCT
         w_index = 4
-        kw = {
-            'b': OSDescHeaderBCount(
-                bCount=len(ext_list),
-                Reserved=0,
-            ),
-        }
     elif issubclass(ext_type, OSExtPropDescHead):
+        header_struct = _OS_DESC_PROP_HEADER_STRUCT
         w_index = 5
-        kw = {
-            'wCount': len(ext_list),
-        }
     else:
         raise TypeError('Extensions of unexpected type')
-    ext_list_type = ext_type * len(ext_list)
-    klass = type(
-        'OSDesc',
-        (OSDescHeader, ),
+    result = _getOSDescType(ext_type, len(ext_list))()
+    buf = serialise(result)
+    header_struct.pack_into(
+        buf,
+        0,
+        interface,
+        len(buf), # dwLength
+        1, # bcdVersion
+        w_index,
+        len(ext_list), # bCount or wCount
+    )
+    buf[header_struct.size:] = b''.join(serialise(x) for x in ext_list)
+    return result
+
+@functools.lru_cache(maxsize=256)
+def _getOSExtPropDescType(name_length, value_length):
+    """
+    Return the (cached) OSExtPropDescHead subclass for given property name and
+    value lengths.
+    """
+    return type(
+        'OSExtPropDesc',
+        (OSExtPropDescHead, ),
         {
             '_fields_': [
-                ('ext_list', ext_list_type),
+                ('bPropertyName', ctypes.c_char * name_length),
+                ('dwPropertyDataLength', le32),
+                ('bProperty', ctypes.c_char * value_length),
             ],
-        },
-    )
-    return klass(
-        interface=interface,
-        dwLength=ctypes.sizeof(klass),
-        bcdVersion=1,
-        wIndex=w_index,
-        ext_list=ext_list_type(*ext_list),
-        **kw
+        }
     )
 
 def getOSExtPropDesc(data_type, name, value):
@@ -354,24 +440,53 @@ def getOSExtPropDesc(data_type, name, value):
         NULL chars must be explicitly included in the value when needed,
         this function does not add any terminating NULL for example.
     """
-    klass = type(
-        'OSExtPropDesc',
-        (OSExtPropDescHead, ),
+    name_length = len(name)
+    result = _getOSExtPropDescType(name_length, len(value))()
+    buf = serialise(result)
+    _OS_EXT_PROP_DESC_HEAD_STRUCT.pack_into(
+        buf,
+        0,
+        len(buf), # dwSize
+        data_type,
+        name_length,
+    )
+    # Not passing values to the constructor, as ctypes stops copying c_char
+    # array values at their first NULL char.
+    name_offset = _OS_EXT_PROP_DESC_HEAD_STRUCT.size
+    buf[name_offset:name_offset + name_length] = name
+    result.dwPropertyDataLength = len(value)
+    buf[len(buf) - len(value):] = value
+    return result
+
+@functools.lru_cache(maxsize=256)
+def _getDescriptorListType(name, type_tuple):
+    """
+    Return the (cached) structure type holding an instance of each type in
+    type_tuple, in order.
+    """
+    return type(
+        name,
+        (ctypes.LittleEndianStructure, ),
         {
+            '_pack_': 1,
             '_fields_': [
-                ('bPropertyName', ctypes.c_char * len(name)),
-                ('dwPropertyDataLength', le32),
-                ('bProperty', ctypes.c_char * len(value)),
+                ('desc_%i' % x, y)
+                for x, y in enumerate(type_tuple)
             ],
         }
     )
-    return klass(
-        dwSize=ctypes.sizeof(klass),
-        dwPropertyDataType=data_type,
-        wPropertyNameLength=len(name),
-        bPropertyName=name,
-        dwPropertyDataLength=len(value),
-        bProperty=value,
+
+@functools.lru_cache(maxsize=256)
+def _getDescsV2Type(name, field_tuple):
+    """
+    Return the (cached) DescsHeadV2 subclass with given extra fields.
+    """
+    return type(
+        name,
+        (DescsHeadV2, ),
+        {
+            '_fields_': list(field_tuple),
+        },
     )
 
 def getDescsV2(flags, fs_list=(), hs_list=(), ss_list=(), os_list=(), eventfd=None):
@@ -407,50 +522,40 @@ def getDescsV2(flags, fs_list=(), hs_list=(), ss_list=(), os_list=(), eventfd=No
         flags |= EVENTFD
         count_field_list.append(('eventfd', le32))
         kw['eventfd'] = eventfd.fileno()
-    for descriptor_list, flag, prefix, allowed_descriptor_klass in (
-        (fs_list, HAS_FS_DESC, 'fs', USBDescriptorHeader),
-        (hs_list, HAS_HS_DESC, 'hs', USBDescriptorHeader),
-        (ss_list, HAS_SS_DESC, 'ss', USBDescriptorHeader),
-        (os_list, HAS_MS_OS_DESC, 'os', OSDescHeader),
+    for (
+        descriptor_list, flag, count_name, descr_name, allowed_descriptor_klass,
+    ) in (
+        (fs_list, HAS_FS_DESC, 'fscount', 'fsdescr', USBDescriptorHeader),
+        (hs_list, HAS_HS_DESC, 'hscount', 'hsdescr', USBDescriptorHeader),
+        (ss_list, HAS_SS_DESC, 'sscount', 'ssdescr', USBDescriptorHeader),
+        (os_list, HAS_MS_OS_DESC, 'oscount', 'osdescr', OSDescHeader),
     ):
         if descriptor_list:
-            for index, descriptor in enumerate(descriptor_list):
-                if not isinstance(descriptor, allowed_descriptor_klass):
+            # Types are needed anyway to get the list's structure type, so
+            # validate them rather than the instances.
+            type_tuple = tuple(type(x) for x in descriptor_list)
+            for index, descriptor_type in enumerate(type_tuple):
+                if not issubclass(descriptor_type, allowed_descriptor_klass):
                     raise TypeError(
                         'Descriptor %r of unexpected type: %r' % (
                             index,
-                            type(descriptor),
+                            descriptor_type,
                         ),
                     )
-            descriptor_map = [
-                ('desc_%i' % x, y)
-                for x, y in enumerate(descriptor_list)
-            ]
             flags |= flag
-            count_name = prefix + 'count'
-            descr_name = prefix + 'descr'
             count_field_list.append((count_name, le32))
-            descr_type = type(
-                't_' + descr_name,
-                (ctypes.LittleEndianStructure, ),
-                {
-                    '_pack_': 1,
-                    '_fields_': [
-                        (x, type(y))
-                        for x, y in descriptor_map
-                    ],
-                }
-            )
+            descr_type = _getDescriptorListType('t_' + descr_name, type_tuple)
             descr_field_list.append((descr_name, descr_type))
-            kw[count_name] = len(descriptor_map)
-            kw[descr_name] = descr_type(**dict(descriptor_map))
+            kw[count_name] = len(type_tuple)
+            # Fields are in list order, no need to name them.
+            kw[descr_name] = descr_type(*descriptor_list)
         elif flags & flag:
             raise ValueError(
                 'Flag %r set but descriptor list empty, cannot generate type.' % (
                     FLAGS.get(flag),
                 )
             )
-    klass = type(
+    klass = _getDescsV2Type(
         'DescsV2_0x%02x' % (
             flags & (
                 HAS_FS_DESC |
@@ -460,18 +565,50 @@ def getDescsV2(flags, fs_list=(), hs_list=(), ss_list=(), os_list=(), eventfd=No
             ),
             # XXX: include contained descriptors type information ? (and name ?)
         ),
-        (DescsHeadV2, ),
-        {
-            '_fields_': count_field_list + descr_field_list,
-        },
+        tuple(count_field_list + descr_field_list),
     )
     return klass(
         magic=DESCRIPTORS_MAGIC_V2,
-        length=ctypes.sizeof(klass),
+        length=_sizeof(klass),
         flags=flags,
         **kw
     )
 
+@functools.lru_cache(maxsize=256)
+def _getStringType(length):
+    """
+    Return the (cached) StringBase subclass holding length bytes of strings.
+    """
+    return type(
+        'String',
+        (StringBase, ),
+        {
+            '_fields_': [
+                ('strings', ctypes.c_char * length),
+            ],
+        },
+    )
+
+@functools.lru_cache(maxsize=256)
+def _getStringsType(layout):
+    """
+    Return the (cached) StringsHead subclass for given layout.
+
+    layout (tuple of 2-tuples)
+        Language ID and length of the strings for this language, in
+        declaration order.
+    """
+    return type(
+        'Strings',
+        (StringsHead, ),
+        {
+            '_fields_': [
+                ('strings_%04x' % lang, _getStringType(length))
+                for lang, length in layout
+            ],
+        },
+    )
+
 def getStrings(lang_dict):
     """
     Return a FunctionFS descriptor suitable for serialisation.
@@ -481,7 +618,7 @@ def getStrings(lang_dict):
         Value: list of unicode objects
         All values must have the same number of items.
     """
-    field_list = []
+    layout_list = []
     kw = {}
     try:
         str_count = len(next(iter(lang_dict.values())))
@@ -491,32 +628,24 @@ def getStrings(lang_dict):
         for lang, string_list in lang_dict.items():
             if len(string_list) != str_count:
                 raise ValueError('All values must have the same string count.')
-            field_id = 'strings_%04x' % lang
-            strings = b'\x00'.join(x.encode('utf-8') for x in string_list) + b'\x00'
-            field_type = type(
-                'String',
-                (StringBase, ),
-                {
-                    '_fields_': [
-                        ('strings', ctypes.c_char * len(strings)),
-                    ],
-                },
-            )
-            field_list.append((field_id, field_type))
-            kw[field_id] = field_type(
-                lang=lang,
-                strings=strings,
-            )
-    klass = type(
-        'Strings',
-        (StringsHead, ),
-        {
-            '_fields_': field_list,
-        },
-    )
+            # Build the whole String structure (lang header included) in a
+            # single buffer, so strings are neither concatenated then copied
+            # to append the final NUL, nor copied again into the structure.
+            buf = bytearray(_STRING_BASE_SIZE)
+            for string in string_list:
+                buf.extend(string.encode('utf-8'))
+                buf.append(0)
+            if not string_list:
+                buf.append(0)
+            length = len(buf) - _STRING_BASE_SIZE
+            layout_list.append((lang, length))
+            value = _getStringType(length).from_buffer(buf)
+            value.lang = lang
+            kw['strings_%04x' % lang] = value
+    klass = _getStringsType(tuple(layout_list))
     return klass(
         magic=STRINGS_MAGIC,
-        length=ctypes.sizeof(klass),
+        length=_sizeof(klass),
         str_count=str_count,
         lang_count=len(lang_dict),
         **kw
@@ -527,13 +656,10 @@ def serialise(structure):
     structure (ctypes.Structure)
         The structure to serialise.
 
-    Returns a ctypes.c_char array.
+    Returns a memoryview of unsigned bytes.
     Does not copy memory.
     """
-    return ctypes.cast(
-        ctypes.pointer(structure),
-        ctypes.POINTER(ctypes.c_char * ctypes.sizeof(structure)),
-    ).contents
+    return memoryview(structure).cast('B')
 
 class EndpointFileBase(io.FileIO):
     """
@@ -542,27 +668,25 @@ class EndpointFileBase(io.FileIO):
     def __init__(self, path):
         super().__init__(path, 'r+')
 
-    def _ioctl(self, func, *args, **kw):
-        result = fcntl.ioctl(self, func, *args, **kw)
-        if result < 0:
-            raise IOError(result)
-        return result
-
 class Endpoint0File(EndpointFileBase):
     """
     File object exposing ioctls available on endpoint zero.
     """
+    # Resolved once, as these are checked on every halt.
+    _EL2HLT = errno.EL2HLT
+    _USB_DIR_IN = ch9.USB_DIR_IN
+
     def halt(self, request_type):
         """
         Halt current endpoint.
         """
         try:
-            if request_type & ch9.USB_DIR_IN:
+            if request_type & self._USB_DIR_IN:
                 self.read(0)
             else:
                 self.write(b'')
         except IOError as exc:
-            if exc.errno != errno.EL2HLT:
+            if exc.errno != self._EL2HLT:
                 raise
         else:
             raise ValueError('halt did not return EL2HLT ?')
@@ -573,7 +697,7 @@ class Endpoint0File(EndpointFileBase):
         interface.
         """
         try:
-            return self._ioctl(INTERFACE_REVMAP, interface)
+            return fcntl.ioctl(self, INTERFACE_REVMAP, interface)
         except IOError as exc:
             if exc.errno == errno.EDOM:
                 return None
@@ -586,12 +710,14 @@ class EndpointFile(EndpointFileBase):
     File object exposing ioctls available on non-zero endpoints.
     """
     _halted = False
+    # Resolved once, as this is checked on every halt.
+    _EBADMSG = errno.EBADMSG
 
     def getRealEndpointNumber(self):
         """
         Returns the host-visible endpoint number.
         """
-        return self._ioctl(ENDPOINT_REVMAP)
+        return fcntl.ioctl(self, ENDPOINT_REVMAP)
 
     def clearHalt(self):
         """
@@ -599,20 +725,20 @@ class EndpointFile(EndpointFileBase):
 
         See drivers/usb/gadget/udc/core.c:usb_ep_clear_halt
         """
-        self._ioctl(CLEAR_HALT)
+        fcntl.ioctl(self, CLEAR_HALT)
         self._halted = False
 
     def getFIFOStatus(self):
         """
         Returns the number of bytes in fifo.
         """
-        return self._ioctl(FIFO_STATUS)
+        return fcntl.ioctl(self, FIFO_STATUS)
 
     def flushFIFO(self):
         """
         Discards Endpoint FIFO content.
         """
-        self._ioctl(FIFO_FLUSH)
+        fcntl.ioctl(self, FIFO_FLUSH)
 
     def getDescriptor(self):
         """
@@ -620,7 +746,7 @@ class EndpointFile(EndpointFileBase):
         (depending on current USB speed).
         """
         result = USBEndpointDescriptor()
-        self._ioctl(ENDPOINT_DESC, result, True)
+        fcntl.ioctl(self, ENDPOINT_DESC, result, True)
         return result
 
     def _halt(self):
@@ -633,7 +759,7 @@ class EndpointFile(EndpointFileBase):
         try:
             self._halt()
         except IOError as exc:
-            if exc.errno != errno.EBADMSG:
+            if exc.errno != self._EBADMSG:
                 raise
         else:
             raise ValueError('halt did not return EBADMSG ?')
@@ -661,6 +787,8 @@ class EndpointINFile(EndpointFile):
         super().__init__(path)
         self._submit = submit
         self._eventfd = eventfd
+        # Completed AIOBlocks, available for reuse by submit.
+        self._aio_block_list = []
 
     @staticmethod
     def read(*_, **__):
@@ -705,57 +833,67 @@ class EndpointINFile(EndpointFile):
         May raise OSError(EAGAIN) if there is currently no room for AIO blocks
         (see __init__ in_aio_blocks_max).
         """
+        aio_block_list = self._aio_block_list
+        if aio_block_list:
+            aio_block = aio_block_list.pop()
+            aio_block.buffer_list = buffer_list
+        else:
+            aio_block = libaio.AIOBlock(
+                mode=libaio.AIOBLOCK_MODE_WRITE,
+                target_file=self,
+                buffer_list=buffer_list,
+                offset=0,
+                eventfd=self._eventfd,
+                onCompletion=self._onComplete,
+            )
+        # Carried by the block itself rather than by a per-submission
+        # functools.partial, so resubmissions do not allocate anything.
+        aio_block.user_data = user_data
         try:
-            self._submit((
-                libaio.AIOBlock(
-                    mode=libaio.AIOBLOCK_MODE_WRITE,
-                    target_file=self,
-                    buffer_list=buffer_list,
-                    offset=0,
-                    eventfd=self._eventfd,
-                    onCompletion=functools.partial(
-                        self._onComplete,
-                        buffer_list,
-                        user_data,
-                    ),
-                ),
-            ))
+            self._submit((aio_block, ))
         except OSError as exc:
+            self._releaseAIOBlock(aio_block)
             if exc.errno != errno.EAGAIN:
                 raise
             self.onSubmitEAGAIN(buffer_list, user_data)
 
-    def _onComplete(
-        self,
-        buffer_list, user_data, # from functools.partial
-        aio_block, res, res2, # from libaio
-    ):
+    def _releaseAIOBlock(self, aio_block):
+        # Drop references to caller's buffers and user data before pooling
+        # the block, so they do not outlive the transfer.
+        aio_block.buffer_list = ()
+        aio_block.user_data = None
+        self._aio_block_list.append(aio_block)
+
+    def _onComplete(self, aio_block, res, res2):
         # res2 is ignored as it just repeats res.
         _ = res2 # silence pylint
+        user_data = aio_block.user_data
         callback_result = self.onComplete(
-            buffer_list,
+            aio_block.buffer_list,
             user_data,
             res,
         )
         if callback_result:
             if res == -errno.ESHUTDOWN:
+                # The block is intentionally neither resubmitted nor returned
+                # to the pool: onComplete misbehaved, and the endpoint is
+                # going away anyway. The next submit allocates a new block.
                 raise ValueError(
                     'onComplete cannot ask to resubmit transfer which '
                     'completed with status %i' % res,
                 )
             if callback_result is not True:
                 aio_block.buffer_list = callback_result
-                aio_block.onCompletion = functools.partial(
-                    self._onComplete,
-                    callback_result,
-                    user_data,
-                )
             try:
                 self._submit((aio_block, ))
             except OSError as exc:
+                buffer_list = aio_block.buffer_list
+                self._releaseAIOBlock(aio_block)
                 if exc.errno != errno.EAGAIN:
                     raise
-                self.onSubmitEAGAIN(aio_block.buffer_list, user_data)
+                self.onSubmitEAGAIN(buffer_list, user_data)
+        else:
+            self._releaseAIOBlock(aio_block)
 
     # pylint: disable=unused-argument
     def onComplete(self, buffer_list, user_data, status):
@@ -805,6 +943,9 @@ class EndpointOUTFile(EndpointFile):
     """
     Read-only endpoint file.
     """
+    # Resolved once, as this is checked on every completion.
+    _MINUS_ESHUTDOWN = -errno.ESHUTDOWN
+
     def __init__(self, path, submit, release, aio_block_list):
         """
         path (string)
@@ -820,9 +961,13 @@ class EndpointOUTFile(EndpointFile):
         super().__init__(path)
         self._submit = submit
         self._release = release
+        # Share a single bound method among all blocks.
+        on_complete = self._onComplete
         for aio_block in aio_block_list:
+            # _onComplete relies on this.
+            assert len(aio_block.buffer_list) == 1, aio_block.buffer_list
             aio_block.target_file = self
-            aio_block.onCompletion = self._onComplete
+            aio_block.onCompletion = on_complete
 
     @staticmethod
     def write(*_, **__):
@@ -849,14 +994,13 @@ class EndpointOUTFile(EndpointFile):
             data = None
             status = res
         else:
-            aio_buffer, = aio_block.buffer_list
-            data = memoryview(aio_buffer)[:res]
+            data = memoryview(aio_block.buffer_list[0])[:res]
             status = 0
         self.onComplete(
             data=data,
             status=status,
         )
-        if res == -errno.ESHUTDOWN:
+        if res == self._MINUS_ESHUTDOWN:
             self._release(aio_block)
         else:
             # XXX: is it good to resubmit on any other error ?
@@ -878,9 +1022,54 @@ class EndpointOUTFile(EndpointFile):
         May be overridden in subclass.
         """
 
+# GET_STATUS replies, indexed by status value. Only the 2 lowest bits are
+# ever set by standard requests handled here.
+_STATUS_BYTES_LIST = tuple(struct.pack('<H', x) for x in range(4))
+
 # FunctionFS can queue up to 4 events, so let's read that much.
 _EP0_EVENT_LIST_TYPE = Event * 4
-_EP0_EVENT_SIZE = ctypes.sizeof(Event)
+# Decodes a whole Event at once, setup fields first (meaningless unless
+# event type is SETUP), then event type.
+_EP0_EVENT_STRUCT = struct.Struct('<BBHHHB3x')
+assert _EP0_EVENT_STRUCT.size == ctypes.sizeof(Event)
+
+# mmap.madvise is only available on python 3.8+.
+_MADV_DONTFORK = (
+    getattr(mmap, 'MADV_DONTFORK', None)
+    if hasattr(mmap.mmap, 'madvise') else
+    None
+)
+
+def _allocateOUTAIOBlockList(max_packet_size, count, per_endpoint, eventfd):
+    """
+    Allocate per_endpoint OUT AIO blocks, each able to receive at least count
+    packets of max_packet_size bytes.
+    """
+    # Each block starts on its own page of a single anonymous map: f_fs
+    # strongly recommends aligning IN buffers to wMaxPacketSize addresses, as
+    # this may be required by some UDCs, assume the same applies to OUT
+    # endpoints. Assume wMaxPacketSize will be less than a page.
+    block_stride = count * max_packet_size
+    block_stride += -block_stride % mmap.PAGESIZE
+    # Let blocks use what page rounding would otherwise leave unused, in whole
+    # packets.
+    block_size = block_stride // max_packet_size * max_packet_size
+    map_size = per_endpoint * block_stride
+    block_map = mmap.mmap(-1, map_size)
+    if _MADV_DONTFORK is not None:
+        # Do not let a fork turn these pages copy-on-write while AIO may be
+        # writing to them.
+        block_map.madvise(_MADV_DONTFORK)
+    block_buffer = memoryview(block_map)
+    return [
+        libaio.AIOBlock(
+            mode=libaio.AIOBLOCK_MODE_READ,
+            buffer_list=(block_buffer[start:start + block_size], ),
+            offset=0,
+            eventfd=eventfd,
+        )
+        for start in range(0, map_size, block_stride)
+    ]
 
 # XXX: how reliable is kernel version checking ?
 _, _, _KERNEL_VERSION, _, _ = os.uname()
@@ -911,6 +1100,10 @@ class Function:
     """
     _open = False
     _ep_list = ()
+    # (isHalted, clearHalt, halt) bound methods of each non-zero endpoint.
+    _ep_halt_method_list = ()
+    # Non-SETUP ep0 event type to bound event handler method.
+    __event_method_dict = {}
     _in_aio_context = _out_aio_context = None
 
     function_remote_wakeup_capable = False
@@ -967,11 +1160,13 @@ class Function:
             Number of OUT transfers to submit for each OUT endpoint.
         out_aio_blocks_max_packet_count (int)
             Maximum number of maximum-size USB packets to receive on each
-            OUT endpoint AIO block.
+            OUT endpoint AIO block. Rounded up so each block uses whole pages.
             Memory usage from these buffers will be:
                 out_aio_blocks_per_endpoint * sum_OUT_wMaxPacketSize *
                 out_aio_blocks_max_packet_count
-            So by default 10kB per 512-bytes OUT endpoint will be allocated.
+            with each block rounded up to a page multiple.
+            So by default 16kB per 512-bytes OUT endpoint will be allocated
+            (with 4kB pages).
         """
         self._path = path
         self._ep_address_dict = ep_address_dict = {}
@@ -986,7 +1181,8 @@ class Function:
         self.__quirks_ffs_unsafe_eventfd = quirks_ffs_unsafe_eventfd = (
             self.quirks_ffs_unsafe_eventfd
         )
-        self._function_descriptor = getDescsV2(
+        # Serialised once, as these are sent to the kernel on each __enter__.
+        self._function_descriptor = serialise(getDescsV2(
             flags,
             fs_list=fs_list,
             hs_list=hs_list,
@@ -997,44 +1193,41 @@ class Function:
                 if quirks_ffs_unsafe_eventfd else
                 eventfd
             ),
-        )
-        self._function_strings = getStrings(dict(lang_dict))
+        ))
+        self._function_strings = serialise(getStrings(dict(lang_dict)))
         self._out_aio_block_list = out_aio_block_list = []
-        self._out_aio_block_dict = out_aio_block_dict = {}
-        self._ep_descriptor_list = ep_descriptor_list = []
-        for descriptor in ss_list or hs_list or fs_list:
-            if descriptor.bDescriptorType == ch9.USB_DT_ENDPOINT:
-                assert descriptor.bEndpointAddress not in ep_address_dict, (
-                    descriptor,
-                    ep_address_dict[descriptor.bEndpointAddress],
+        # What __enter__ needs to open each non-zero endpoint:
+        # (path, is_in, descriptor, OUT AIO block list or None)
+        self._ep_open_list = ep_open_list = []
+        ep_descriptor_list = [
+            descriptor
+            for descriptor in ss_list or hs_list or fs_list
+            if descriptor.bDescriptorType == ch9.USB_DT_ENDPOINT
+        ]
+        for index, descriptor in enumerate(ep_descriptor_list, 1):
+            address = descriptor.bEndpointAddress
+            assert address not in ep_address_dict, (
+                descriptor,
+                ep_address_dict[address],
+            )
+            ep_address_dict[address] = index
+            endpoint_path = os.path.join(path, 'ep%u' % (index, ))
+            if address & ch9.USB_DIR_IN:
+                ep_open_list.append((endpoint_path, True, descriptor, None))
+            else:
+                ep_aio_block_list = _allocateOUTAIOBlockList(
+                    max_packet_size=descriptor.wMaxPacketSize,
+                    count=out_aio_blocks_max_packet_count,
+                    per_endpoint=out_aio_blocks_per_endpoint,
+                    eventfd=eventfd,
                 )
-                ep_descriptor_list.append(descriptor)
-                is_in = descriptor.bEndpointAddress & ch9.USB_DIR_IN
-                index = len(ep_descriptor_list)
-                ep_address_dict[descriptor.bEndpointAddress] = index
-                if not is_in:
-                    out_aio_block_dict[index] = ep_aio_block_list = []
-                    for _ in range(out_aio_blocks_per_endpoint):
-                        # Using mmap to get a page-aligned buffer. f_fs strongly
-                        # recommends aligning IN buffers to wMaxPacketSize
-                        # addresses, as this may be required by some UDCs,
-                        # assume the same applies to OUT endpoints.
-                        # Assume wMaxPacketSize will be less than a page.
-                        out_block = libaio.AIOBlock(
-                            mode=libaio.AIOBLOCK_MODE_READ,
-                            buffer_list=(
-                                mmap.mmap(
-                                    -1, # Anonymous map
-                                    out_aio_blocks_max_packet_count *
-                                    descriptor.wMaxPacketSize,
-                                ),
-                            ),
-                            offset=0,
-                            eventfd=eventfd,
-                        )
-                        ep_aio_block_list.append(out_block)
-                        out_aio_block_list.append(out_block)
-        self._ep0_event_list = _EP0_EVENT_LIST_TYPE()
+                ep_open_list.append(
+                    (endpoint_path, False, descriptor, ep_aio_block_list),
+                )
+                out_aio_block_list.extend(ep_aio_block_list)
+        # Events are decoded with _EP0_EVENT_STRUCT, so only a byte view of
+        # the event array is needed.
+        self._ep0_event_buffer = memoryview(_EP0_EVENT_LIST_TYPE()).cast('B')
         if quirks_ffs_unsafe_eventfd:
             # Piggy-back on the "in" AIO context for ep0 poll AIO block
             in_aio_blocks_max += 1
@@ -1065,13 +1258,21 @@ class Function:
         try:
             ep0 = Endpoint0File(os.path.join(self._path, 'ep0'))
             self._ep_list = ep_list = [ep0]
-            ep0.write(serialise(self._function_descriptor))
-            ep0.write(serialise(self._function_strings))
-            out_aio_block_dict = self._out_aio_block_dict
-            for descriptor in self._ep_descriptor_list:
-                index = len(ep_list)
-                endpoint_path = os.path.join(self._path, 'ep%u' % (index, ))
-                is_in = bool(descriptor.bEndpointAddress & ch9.USB_DIR_IN)
+            function_descriptor = self._function_descriptor
+            function_strings = self._function_strings
+            # ep0 only implements write (and not write_iter), so the kernel
+            # calls it once per buffer, as f_fs expects: send both in a single
+            # syscall.
+            if os.writev(
+                ep0.fileno(),
+                (function_descriptor, function_strings),
+            ) != len(function_descriptor) + len(function_strings):
+                # Descriptors were accepted but not strings: retry these alone
+                # to get the error.
+                ep0.write(function_strings)
+            for (
+                endpoint_path, is_in, descriptor, ep_aio_block_list,
+            ) in self._ep_open_list:
                 endpoint_class = self.getEndpointClass(
                     is_in=is_in,
                     descriptor=descriptor,
@@ -1088,15 +1289,23 @@ class Function:
                         path=endpoint_path,
                         submit=self._out_aio_context.submit,
                         release=self._out_aio_block_list.append,
-                        aio_block_list=out_aio_block_dict[index],
+                        aio_block_list=ep_aio_block_list,
                     )
                 # pylint: enable=unexpected-keyword-arg,no-value-for-parameter
                 ep_list.append(ep_file)
-            fcntl.fcntl(
-                ep0,
-                fcntl.F_SETFL,
-                fcntl.fcntl(ep0, fcntl.F_GETFL) | os.O_NONBLOCK,
-            )
+            self._ep_halt_method_list = [
+                (x.isHalted, x.clearHalt, x.halt)
+                for x in ep_list[1:]
+            ]
+            self.__event_method_dict = {
+                event_type: getattr(self, method_name)
+                for event_type, method_name in self.__event_dict.items()
+            }
+            # Only switch to non-blocking once descriptors are written, as
+            # f_fs may then fail them with EAGAIN on lock contention.
+            # ep0 was opened above without any of the flags F_SETFL
+            # modifies, so there is no need to F_GETFL them first.
+            fcntl.fcntl(ep0, fcntl.F_SETFL, os.O_NONBLOCK)
             if self.__quirks_ffs_unsafe_eventfd:
                 self.__ep0_aio_block.target_file = ep0
                 self._in_aio_context.submit((self.__ep0_aio_block, ))
@@ -1116,6 +1325,8 @@ class Function:
         out_aio_context = self._out_aio_context
         if out_aio_context is not None:
             out_aio_context.cancelAll()
+        self._ep_halt_method_list = ()
+        self.__event_method_dict = {}
         ep_list = self._ep_list
         while ep_list:
             ep_list.pop().close()
@@ -1238,33 +1449,37 @@ class Function:
         """
         Read and handle endpoint 0 kernel events.
         """
-        event_list = self._ep0_event_list
-        length = self.ep0.readinto(event_list)
+        ep0 = self.ep0
+        ep0_event_buffer = self._ep0_event_buffer
+        length = ep0.readinto(ep0_event_buffer)
         if length:
-            event_dict = self.__event_dict
-            index = 0
-            while length >= _EP0_EVENT_SIZE:
-                event = event_list[index]
-                index += 1
-                length -= _EP0_EVENT_SIZE
-                event_type = event.type
+            assert length % _EP0_EVENT_STRUCT.size == 0, (
+                length,
+                _EP0_EVENT_STRUCT.size,
+            )
+            event_method_dict = self.__event_method_dict
+            # Unpacking each event in one go is much cheaper than accessing
+            # its fields through ctypes.
+            for (
+                request_type, request, value, index, setup_length, event_type,
+            ) in _EP0_EVENT_STRUCT.iter_unpack(
+                ep0_event_buffer[:length],
+            ):
                 if event_type == SETUP:
-                    setup = event.u.setup
                     try:
                         self.onSetup(
-                            setup.bRequestType,
-                            setup.bRequest,
-                            setup.wValue,
-                            setup.wIndex,
-                            setup.wLength,
+                            request_type,
+                            request,
+                            value,
+                            index,
+                            setup_length,
                         )
                     except:
                         # On *ANY* exception, halt endpoint
-                        self.ep0.halt(setup.bRequestType)
+                        ep0.halt(request_type)
                         raise
                 else:
-                    getattr(self, event_dict[event_type])()
-            assert length == 0, (index, length, _EP0_EVENT_SIZE)
+                    event_method_dict[event_type]()
 
     def getEndpoint(self, index):
         """
@@ -1337,6 +1552,96 @@ class Function:
         """
         self.function_remote_wakeup = True
 
+    # Standard setup request handlers.
+    # Called with the setup request's index and length, the other fields being
+    # fixed by the handler's key in __standard_setup_dict.
+    # Return whether the request was handled, in which case the data or status
+    # stage has been completed. Otherwise, caller halts endpoint 0.
+    def _getInterfaceStatus(self, index, length):
+        if length == 2:
+            status = 0
+            # Only the first interface of the function reports these bits.
+            if index == 0:
+                if self.function_remote_wakeup_capable:
+                    status |= ch9.USB_INTRF_STAT_FUNC_RW_CAP
+                if self.function_remote_wakeup:
+                    status |= ch9.USB_INTRF_STAT_FUNC_RW
+            self.ep0.write(_STATUS_BYTES_LIST[status])
+            return True
+        return False
+
+    def _getEndpointStatus(self, index, length):
+        method_list = self._ep_halt_method_list
+        if length == 2 and 0 < index <= len(method_list):
+            is_halted, _, _ = method_list[index - 1]
+            self.ep0.write(_STATUS_BYTES_LIST[bool(is_halted())])
+            return True
+        return False
+
+    def _clearEndpointHalt(self, index, length):
+        method_list = self._ep_halt_method_list
+        if length == 0 and 0 < index <= len(method_list):
+            _, clear_halt, _ = method_list[index - 1]
+            clear_halt()
+            self.ep0.read(0)
+            return True
+        return False
+
+    def _clearInterfaceFunctionSuspend(self, index, length):
+        _ = index # Silence pylint
+        if length == 0 and self.function_remote_wakeup_capable:
+            self.disableRemoteWakeup()
+            self.ep0.read(0)
+            return True
+        return False
+
+    def _setEndpointHalt(self, index, length):
+        method_list = self._ep_halt_method_list
+        if length == 0 and 0 < index <= len(method_list):
+            _, _, halt = method_list[index - 1]
+            halt()
+            self.ep0.read(0)
+            return True
+        return False
+
+    def _setInterfaceFunctionSuspend(self, index, length):
+        _ = index # Silence pylint
+        if length == 0 and self.function_remote_wakeup_capable:
+            self.enableRemoteWakeup()
+            self.ep0.read(0)
+            return True
+        return False
+
+    # Key: bRequestType << 24 | bRequest << 16 | wValue
+    __standard_setup_dict = {
+        (
+            ch9.USB_DIR_IN | ch9.USB_TYPE_STANDARD | ch9.USB_RECIP_INTERFACE
+        ) << 24 | ch9.USB_REQ_GET_STATUS << 16 | 0: _getInterfaceStatus,
+        (
+            ch9.USB_DIR_IN | ch9.USB_TYPE_STANDARD | ch9.USB_RECIP_ENDPOINT
+        ) << 24 | ch9.USB_REQ_GET_STATUS << 16 | 0: _getEndpointStatus,
+        (
+            ch9.USB_DIR_OUT | ch9.USB_TYPE_STANDARD | ch9.USB_RECIP_ENDPOINT
+        ) << 24 | ch9.USB_REQ_CLEAR_FEATURE << 16 | ch9.USB_ENDPOINT_HALT: (
+            _clearEndpointHalt
+        ),
+        (
+            ch9.USB_DIR_OUT | ch9.USB_TYPE_STANDARD | ch9.USB_RECIP_INTERFACE
+        ) << 24 | ch9.USB_REQ_CLEAR_FEATURE << 16 | (
+            ch9.USB_INTRF_FUNC_SUSPEND
+        ): _clearInterfaceFunctionSuspend,
+        (
+            ch9.USB_DIR_OUT | ch9.USB_TYPE_STANDARD | ch9.USB_RECIP_ENDPOINT
+        ) << 24 | ch9.USB_REQ_SET_FEATURE << 16 | ch9.USB_ENDPOINT_HALT: (
+            _setEndpointHalt
+        ),
+        (
+            ch9.USB_DIR_OUT | ch9.USB_TYPE_STANDARD | ch9.USB_RECIP_INTERFACE
+        ) << 24 | ch9.USB_REQ_SET_FEATURE << 16 | (
+            ch9.USB_INTRF_FUNC_SUSPEND
+        ): _setInterfaceFunctionSuspend,
+    }
+
     def onSetup(self, request_type, request, value, index, length):
         """
         Called when a setup USB transaction was received.
@@ -1352,76 +1657,11 @@ class Function:
 
         May be overridden in subclass.
         """
-        # pylint: disable=too-many-nested-blocks, too-many-statements
-        # pylint: disable=too-many-branches
-        if (request_type & ch9.USB_TYPE_MASK) == ch9.USB_TYPE_STANDARD:
-            recipient = request_type & ch9.USB_RECIP_MASK
-            is_in = (request_type & ch9.USB_DIR_IN) == ch9.USB_DIR_IN
-            if request == ch9.USB_REQ_GET_STATUS:
-                if is_in and length == 2:
-                    if recipient == ch9.USB_RECIP_INTERFACE:
-                        if value == 0:
-                            status = 0
-                            if index == 0:
-                                if self.function_remote_wakeup_capable:
-                                    status |= 1 << 0
-                                if self.function_remote_wakeup:
-                                    status |= 1 << 1
-                            self.ep0.write(struct.pack('<H', status)[:length])
-                            return
-                    elif recipient == ch9.USB_RECIP_ENDPOINT:
-                        if value == 0:
-                            try:
-                                endpoint = self.getEndpoint(index)
-                            except IndexError:
-                                pass
-                            else:
-                                status = 0
-                                if endpoint.isHalted():
-                                    status |= 1 << 0
-                                self.ep0.write(
-                                    struct.pack('<H', status)[:length],
-                                )
-                                return
-            elif request == ch9.USB_REQ_CLEAR_FEATURE:
-                if not is_in and length == 0:
-                    if recipient == ch9.USB_RECIP_ENDPOINT:
-                        if value == ch9.USB_ENDPOINT_HALT:
-                            try:
-                                endpoint = self.getEndpoint(index)
-                            except IndexError:
-                                pass
-                            else:
-                                endpoint.clearHalt()
-                                self.ep0.read(0)
-                                return
-                    elif recipient == ch9.USB_RECIP_INTERFACE:
-                        if value == ch9.USB_INTRF_FUNC_SUSPEND:
-                            if self.function_remote_wakeup_capable:
-                                self.disableRemoteWakeup()
-                                self.ep0.read(0)
-                                return
-            elif request == ch9.USB_REQ_SET_FEATURE:
-                if not is_in and length == 0:
-                    if recipient == ch9.USB_RECIP_ENDPOINT:
-                        if value == ch9.USB_ENDPOINT_HALT:
-                            try:
-                                endpoint = self.getEndpoint(index)
-                            except IndexError:
-                                pass
-                            else:
-                                endpoint.halt()
-                                self.ep0.read(0)
-                                return
-                    elif recipient == ch9.USB_RECIP_INTERFACE:
-                        if value == ch9.USB_INTRF_FUNC_SUSPEND:
-                            if self.function_remote_wakeup_capable:
-                                self.enableRemoteWakeup()
-                                self.ep0.read(0)
-                                return
-        self.ep0.halt(request_type)
-        # pylint: enable=too-many-nested-blocks, too-many-statements
-        # pylint: enable=too-many-branches
+        handler = self.__standard_setup_dict.get(
+            request_type << 24 | request << 16 | value,
+        )
+        if handler is None or not handler(self, index, length):
+            self.ep0.halt(request_type)
 
     def onSuspend(self):
         """
@@ -1611,15 +1851,15 @@ class HIDFunction(Function):
         super().__init__(
             path,
             fs_list=fs_list or buildDescriptor(
-                _MAX_PACKET_SIZE_DICT[ch9.USB_ENDPOINT_XFER_INT][0],
+                _MAX_PACKET_SIZE_TABLE[ch9.USB_ENDPOINT_XFER_INT][0],
                 full_speed_interval,
             ),
             hs_list=hs_list or buildDescriptor(
-                _MAX_PACKET_SIZE_DICT[ch9.USB_ENDPOINT_XFER_INT][1],
+                _MAX_PACKET_SIZE_TABLE[ch9.USB_ENDPOINT_XFER_INT][1],
                 high_speed_interval,
             ),
             ss_list=ss_list or buildDescriptor(
-                _MAX_PACKET_SIZE_DICT[ch9.USB_ENDPOINT_XFER_INT][2],
+                _MAX_PACKET_SIZE_TABLE[ch9.USB_ENDPOINT_XFER_INT][2],
                 high_speed_interval,
                 need_companion=True,
             ),
@@ -1640,7 +1880,8 @@ class HIDFunction(Function):
     def onSetup(self, request_type, request, value, index, length):
         if (request_type & ch9.USB_RECIP_MASK) == ch9.USB_RECIP_INTERFACE:
             is_in = (request_type & ch9.USB_DIR_IN) == ch9.USB_DIR_IN
-            if (request_type & ch9.USB_TYPE_MASK) == ch9.USB_TYPE_STANDARD:
+            type_ = request_type & ch9.USB_TYPE_MASK
+            if type_ == ch9.USB_TYPE_STANDARD:
                 if request == ch9.USB_REQ_GET_DESCRIPTOR and is_in:
                     descriptor_list = self.hid_descritptor_dict.get(
                         value >> 8, # Descriptor Type
@@ -1666,7 +1907,7 @@ class HIDFunction(Function):
                 elif request == ch9.USB_REQ_SET_DESCRIPTOR and not is_in:
                     self.setInterfaceDescriptor(value, index, length)
                     return
-            elif (request_type & ch9.USB_TYPE_MASK) == ch9.USB_TYPE_CLASS:
+            elif type_ == ch9.USB_TYPE_CLASS:
                 try:
                     method_id = self.hid_class_request_dict[(is_in, request)]
                 except KeyError:
@@ -14,15 +14,12 @@
 # You should have received a copy of the GNU General Public License
 # along with python-functionfs.  If not, see <http://www.gnu.org/licenses/>.
 import ctypes
-import sys
+import types
 
 class Enum:
-    def __init__(self, member_dict, scope_dict=None):
-        if scope_dict is None:
-            # Affect caller's locals, not this module's.
-            # pylint: disable=protected-access
-            scope_dict = sys._getframe(1).f_locals
-            # pylint: enable=protected-access
+    __slots__ = ('forward_dict', 'reverse_dict')
+
+    def __init__(self, member_dict, scope_dict):
         forward_dict = {}
         reverse_dict = {}
         next_value = 0
@@ -37,8 +34,9 @@ class Enum:
                 ))
             reverse_dict[value] = name
             scope_dict[name] = value
-        self.forward_dict = forward_dict
-        self.reverse_dict = reverse_dict
+        # Enums are immutable once created.
+        self.forward_dict = types.MappingProxyType(forward_dict)
+        self.reverse_dict = types.MappingProxyType(reverse_dict)
 
     def __call__(self, value):
         return self.reverse_dict[value]
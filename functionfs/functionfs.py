@@ -40,7 +40,7 @@ FLAGS = Enum({
     'EVENTFD': 32,
     'ALL_CTRL_RECIP': 64,
     'CONFIG0_SETUP': 128,
-})
+}, globals())
 
 # Descriptor of an non-audio endpoint
 
@@ -96,6 +96,7 @@ class DescsHead(ctypes.LittleEndianStructure):
     ]
 
 class OSDescHeaderBCount(ctypes.LittleEndianStructure):
+    _pack_ = 1
     _fields_ = (
         ('bCount', u8),
         ('Reserved', u8),
@@ -128,31 +129,54 @@ class OSDescHeader(ctypes.LittleEndianStructure):
     |  11 | ExtProp[]       |      | list of ext. prop. d.    |
     """
     _pack_ = 1
-    _anonymous_ = [
-        'u',
-    ]
+    # bCount and Reserved overlap wCount: rather than a nested union, store
+    # wCount and derive the others from it.
     _fields_ = [
         ('interface', u8),
         ('dwLength', le32),
         ('bcdVersion', le16),
         ('wIndex', le16),
-        (
-            'u',
-            type(
-                'Count',
-                (ctypes.Union, ),
-                {
-                    '_fields_': [
-                        ('b', OSDescHeaderBCount),
-                        ('wCount', le16),
-                    ],
-                },
-            ),
-        ),
+        ('wCount', le16),
     ]
 
+    @property
+    def b(self):
+        """
+        OSDescHeaderBCount view of wCount.
+        """
+        return OSDescHeaderBCount.from_buffer(
+            self,
+            type(self).wCount.offset,
+        )
+
+    @b.setter
+    def b(self, value):
+        self.wCount = value.bCount | (value.Reserved << 8) # pylint: disable=invalid-name
+
+    @property
+    def bCount(self): # pylint: disable=invalid-name
+        """
+        Low byte of wCount.
+        """
+        return self.wCount & 0xff
+
+    @bCount.setter
+    def bCount(self, value): # pylint: disable=invalid-name
+        self.wCount = (self.wCount & 0xff00) | value
+
+    @property
+    def Reserved(self): # pylint: disable=invalid-name
+        """
+        High byte of wCount.
+        """
+        return self.wCount >> 8
+
+    @Reserved.setter
+    def Reserved(self, value): # pylint: disable=invalid-name
+        self.wCount = (self.wCount & 0xff) | (value << 8)
+
 class OSExt(ctypes.LittleEndianStructure):
-    pass
+    _pack_ = 1
 
 class OSExtCompatDesc(OSExt):
     """
@@ -248,7 +272,15 @@ EVENT_TYPE = Enum({
 
     'SUSPEND': 5,
     'RESUME': 6,
-})
+}, globals())
+
+class _EventUnion(ctypes.Union):
+    _pack_ = 1
+    _fields_ = [
+        # SETUP: packet; DATA phase i/o precedes next event
+        # (setup.bmRequestType & USB_DIR_IN) flags direction
+        ('setup', USBCtrlRequest),
+    ]
 
 class Event(ctypes.LittleEndianStructure):
     """
@@ -261,20 +293,7 @@ class Event(ctypes.LittleEndianStructure):
     """
     _pack_ = 1
     _fields_ = [
-        (
-            'u',
-            type(
-                'u',
-                (ctypes.Union, ),
-                {
-                    '_fields_': [
-                        # SETUP: packet; DATA phase i/o precedes next event
-                        # (setup.bmRequestType & USB_DIR_IN) flags direction
-                        ('setup', USBCtrlRequest),
-                    ],
-                }
-            ),
-        ),
+        ('u', _EventUnion),
 
         # event_type
         ('type', u8),
@@ -67,6 +67,24 @@ _umount.errcheck = _checkCCall
 
 _READY_MARKER = b'ready'
 
+# Configuration attribute names, and how to format their value for configfs.
+_CONFIG_ATTRIBUTE_CAST_LIST = (
+    ('bmAttributes', lambda x: hex(x).encode('ascii')),
+    ('MaxPower', lambda x: b'%i' % (x, )),
+)
+
+def _writeAttribute(path, value):
+    """
+    Write value (bytes) to configfs attribute at path.
+    configfs attributes take their whole value in a single write, so bypass
+    buffered file objects.
+    """
+    attribute_fd = os.open(path, os.O_WRONLY | os.O_CLOEXEC)
+    try:
+        os.write(attribute_fd, value)
+    finally:
+        os.close(attribute_fd)
+
 class Gadget:
     """
     Declare a gadget, with the strings, configurations, and functions it
@@ -147,19 +165,22 @@ class Gadget:
             fit in 7 bytes.
         """
         if udc is None:
+            # Only the first 2 entries are needed to tell whether there is
+            # exactly one UDC.
             try:
-                udc_list = os.listdir(self.class_udc_path)
+                with os.scandir(self.class_udc_path) as udc_iterator:
+                    udc_list = list(itertools.islice(udc_iterator, 2))
             except FileNotFoundError:
                 udc_list = ()
             try:
-                udc, = udc_list
+                udc_entry, = udc_list
             except ValueError:
                 raise ValueError(
                     'More than one UDC available'
                     if udc_list else
                     'No UDC available'
                 ) from None
-            udc = os.path.basename(udc)
+            udc = udc_entry.name
         elif not os.path.exists(os.path.join(self.class_udc_path, udc)):
             raise ValueError('No such UDC')
         self.__udc = udc
@@ -168,13 +189,8 @@ class Gadget:
                 {
                     'function_list': tuple(config_dict['function_list']),
                     'attribute_dict': {
-                        attribute_name: cast(
-                            config_dict[attribute_name],
-                        ).encode('ascii')
-                        for attribute_name, cast in (
-                            ('bmAttributes', hex),
-                            ('MaxPower', lambda x: '%i' % (x, )),
-                        )
+                        attribute_name: cast(config_dict[attribute_name])
+                        for attribute_name, cast in _CONFIG_ATTRIBUTE_CAST_LIST
                         if config_dict.get(attribute_name) is not None
                     },
                     'lang_dict': {
@@ -205,15 +221,15 @@ class Gadget:
         }
         self.__attribute_dict = {
             name: hex(value).encode('ascii')
-            for name, value in {
-                'idVendor': idVendor,
-                'idProduct': idProduct,
-                'bcdDevice': bcdDevice,
-                'bcdUSB': bcdUSB,
-                'bDeviceProtocol': bDeviceProtocol,
-                'bDeviceClass': bDeviceClass,
-                'bDeviceSubClass': bDeviceSubClass,
-            }.items()
+            for name, value in (
+                ('idVendor', idVendor),
+                ('idProduct', idProduct),
+                ('bcdDevice', bcdDevice),
+                ('bcdUSB', bcdUSB),
+                ('bDeviceProtocol', bDeviceProtocol),
+                ('bDeviceClass', bDeviceClass),
+                ('bDeviceSubClass', bDeviceSubClass),
+            )
             if value is not None
         }
         self.__os_desc = (
@@ -243,8 +259,10 @@ class Gadget:
 
     def __writeAttributeDict(self, base, attribute_dict):
         for attribute_name, attribute_value in attribute_dict.items():
-            with open(os.path.join(base, attribute_name), 'wb') as attribute_file:
-                attribute_file.write(attribute_value)
+            _writeAttribute(
+                os.path.join(base, attribute_name),
+                attribute_value,
+            )
 
     def __writeLangDict(self, base, lang_dict):
         result = []
@@ -296,8 +314,7 @@ class Gadget:
             raise
         self.__real_name = name
         for key, value in self.__os_desc:
-            with open(os.path.join(name, key), 'wb') as desc_file:
-                desc_file.write(value)
+            _writeAttribute(os.path.join(name, key), value)
         dir_list.extend(self.__writeLangDict(name, self.__lang_dict))
         self.__writeAttributeDict(name, self.__attribute_dict)
         function_list = self.__function_list = []
@@ -358,8 +375,7 @@ class Gadget:
             function.wait()
         udc_path = os.path.join(name, 'UDC')
         try:
-            with open(udc_path, 'w', encoding='ascii') as udc:
-                udc.write(self.__udc)
+            _writeAttribute(udc_path, self.__udc.encode('ascii'))
         except (IOError, OSError) as exc:
             if exc.errno == 524: # ENOTSUPP, which is not ENOTSUP
                 exc.strerror = 'UDC cannot allocate this many endpoints'
@@ -383,8 +399,9 @@ class Gadget:
             return
         udc_path = self.__udc_path
         if udc_path:
-            with open(udc_path, 'w', encoding='ascii') as udc:
-                udc.write('')
+            # An empty write never reaches the attribute, so write a lone
+            # newline, which the kernel strips to an empty UDC name.
+            _writeAttribute(udc_path, b'\n')
         function_list = self.__function_list
         for function in function_list:
             try:
@@ -704,12 +721,10 @@ class ConfigFunctionKernel(
         """
         self.__path = path
         for option_path, option_value in self.__config_dict.items():
-            with open(
+            _writeAttribute(
                 self._getOptionAbsPath(path, option_path),
-                'w',
-                encoding='ascii',
-            ) as option_file:
-                option_file.write(option_value)
+                option_value.encode('ascii'),
+            )
 
     def join(self):
         """
@@ -775,6 +790,22 @@ class ConfigFunctionFFS(ConfigFunctionBase): # pylint: disable=abstract-method
         self._fmode = fmode
         self._mode = mode
         self._no_disconnect = no_disconnect
+        # Only depends on constructor arguments, so build it once.
+        self._mount_options = b','.join(
+            b'%s=%i' % (
+                key.encode('ascii'),
+                cast(value),
+            )
+            for key, cast, value in (
+                ('uid', int, uid),
+                ('gid', int, gid),
+                ('rmode', int, rmode),
+                ('fmode', int, fmode),
+                ('mode', int, mode),
+                ('no_disconnect', bool, no_disconnect),
+            )
+            if value is not None
+        )
 
     def getFunction(self, path):
         """
@@ -801,21 +832,7 @@ class ConfigFunctionFFS(ConfigFunctionBase): # pylint: disable=abstract-method
             mountpoint.encode('ascii'),
             b'functionfs',
             0,
-            b','.join(
-                b'%s=%i' % (
-                    key.encode('ascii'),
-                    cast(value),
-                )
-                for key, cast, value in (
-                    ('uid', int, self._uid),
-                    ('gid', int, self._gid),
-                    ('rmode', int, self._rmode),
-                    ('fmode', int, self._fmode),
-                    ('mode', int, self._mode),
-                    ('no_disconnect', bool, self._no_disconnect),
-                )
-                if value is not None
-            ),
+            self._mount_options,
         )
         self._mountpoint = mountpoint
 
@@ -905,8 +922,14 @@ class ConfigFunctionFFSSubprocess(ConfigFunctionFFS):
         """
         Block until the function subprocess signalled readiness.
         """
-        with os.fdopen(self.__read_pipe, 'rb', 0) as read_pipef:
-            read_pipef.read(len(_READY_MARKER))
+        read_pipe = self.__read_pipe
+        self.__read_pipe = None
+        try:
+            # Writes smaller than PIPE_BUF are atomic, so a single read gets
+            # the whole marker (or nothing if the subprocess died early).
+            os.read(read_pipe, len(_READY_MARKER))
+        finally:
+            os.close(read_pipe)
 
     def kill(self):
         """